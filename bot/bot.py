@@ -13,9 +13,8 @@ from bot.controller import (
     CoinController,
     D6Controller,
     HelpController,
-    DynamicRerollButton,
-    DynamicFreeRerollButton,
-    DynamicAllInButton,)
+    DynamicRollButton,
+    MAX_DICE,)
 from bot.dice import DiceSet
 
 
@@ -35,7 +34,7 @@ class MyClient(discord.Client):
         This ensures that they are available right away, without the delay of up to an hour.
         """
         # Register dynamic buttons, so they still work after the bot restarts.
-        self.add_dynamic_items(DynamicRerollButton, DynamicFreeRerollButton, DynamicAllInButton)
+        self.add_dynamic_items(DynamicRollButton)
         if self.dev_guild:
             self.tree.copy_global_to(guild=self.dev_guild)
         await self.tree.sync(guild=self.dev_guild)
@@ -73,9 +72,9 @@ def main():
 
     @client.tree.command()
     @app_commands.describe(
-        dice='The number of dice to roll',
+        dice=f'The number of dice to roll (up to {MAX_DICE})',
     )
-    async def roll(interaction: discord.Interaction, dice: int):
+    async def roll(interaction: discord.Interaction, dice: app_commands.Range[int, 1, MAX_DICE]):
         """Roll a number of Outgunned dice."""
         await RollController().handle_roll(interaction, dice)
 
@@ -89,7 +88,9 @@ def main():
         """Roll a d6."""
         await D6Controller().handle_d6(interaction)
 
-    client.run(config.token)
+    # Let discord.py set up logging for the root logger, so our own module
+    # loggers are handled as well.
+    client.run(config.token, root_logger=True)
 
 if __name__ == '__main__':
     main()
@@ -1,10 +1,13 @@
 """Encapsulates the user specified settings for a channel."""
 
+import logging
 import shelve
 
 from bot.config import config
 from bot.dice import DiceSet
 
+log = logging.getLogger(__name__)
+
 class ChannelSettings:
     """Encapsulates the user specified settings for a channel."""
     def __init__(self):
@@ -31,7 +34,7 @@ class ChannelSettings:
             channel_id: The ID of the channel.
             dice_set: The dice set for the channel.
         """
-        print(f'Setting dice set for channel {channel_id}:', dice_set)
+        log.info('Setting dice set for channel %s: %s', channel_id, dice_set)
         self.db[str(channel_id)] = dice_set
 
 
@@ -4,21 +4,108 @@ This module contains classes for handling commands for the Outgunned bot,
 including generating the view for the roll command with buttons for rerolling,
 free rerolling, and going all in.
 """
-from abc import ABC, abstractmethod
+import asyncio
+from collections.abc import Callable
+import contextlib
+import functools
+import logging
 import re
+from typing import NamedTuple
 import discord
 from bot.dice import DiceSet
 from bot.message import MessageGenerator, MessageParser
 from bot.roll import RollHistory, Roller
 from bot.channel_settings import channel_settings
 
+log = logging.getLogger(__name__)
+
 EMBED_COLOR = discord.Color.gold()
 
+def make_embed(description: str) -> discord.Embed:
+    """Returns an embed with the given description in the bot's color."""
+    # NB: Embed.from_dict() measured about 5x slower than the constructor, so
+    #     we stick with the latter.
+    return discord.Embed(description=description, color=EMBED_COLOR)
+
+# Message generator for messages that don't depend on the channel's dice set.
+_default_message_generator = MessageGenerator()
+
+# The help text is static, so its embed can be built once. discord.py only
+# serializes embeds when sending, so it's safe to reuse.
+_HELP_EMBED = make_embed(_default_message_generator.generate_help_message())
+
+@functools.lru_cache(maxsize=16)
+def message_generator_for_dice_set(dice_set: DiceSet) -> MessageGenerator:
+    """Returns a shared message generator for the given dice set."""
+    return MessageGenerator(dice_set)
+
+# The maximum number of dice per roll. Beyond roughly 30 dice, a roll message
+# using custom emoji (with a re-roll and going all in) can exceed Discord's
+# 4096 character embed limit, so we leave some headroom.
+MAX_DICE = 20
+
+# Upper bound for the number of button callbacks doing work at the same time.
+MAX_CONCURRENT_BUTTON_CALLBACKS = 32
+
+_button_callback_semaphore = asyncio.Semaphore(MAX_CONCURRENT_BUTTON_CALLBACKS)
+# The future of the most recent button callback per channel, which is resolved
+# once that callback is done.
+_channel_queue_tails: dict[int, asyncio.Future] = {}
+
+@contextlib.asynccontextmanager
+async def button_callback_slot(channel_id: int):
+    """Limits concurrent button callbacks and serializes them per channel.
+
+    discord.py already runs each callback in its own task, so callbacks in
+    different channels proceed concurrently, up to the global limit. Callbacks
+    within the same channel are processed in the order they arrived.
+
+    Entering the context claims the callback's place in its channel's line
+    right away, before anything is awaited. The yielded coroutine function
+    waits for the callback's turn, so the interaction can be deferred in
+    between without letting later callbacks overtake it. A callback only takes
+    up a global slot once it's its channel's turn.
+    """
+    previous = _channel_queue_tails.get(channel_id)
+    done = asyncio.get_running_loop().create_future()
+    _channel_queue_tails[channel_id] = done
+    acquired = False
+
+    async def wait_for_turn():
+        nonlocal acquired
+        if previous is not None:
+            # NB: asyncio.wait() doesn't cancel the future if we're cancelled.
+            await asyncio.wait([previous])
+        await _button_callback_semaphore.acquire()
+        acquired = True
+
+    def finish(_=None):
+        done.set_result(None)
+        if _channel_queue_tails.get(channel_id) is done:
+            del _channel_queue_tails[channel_id]
+
+    try:
+        yield wait_for_turn
+    finally:
+        if acquired:
+            _button_callback_semaphore.release()
+        # If we're leaving early (e.g. the defer failed), later callbacks still
+        # have to wait for the ones before us.
+        if previous is None or previous.done():
+            finish()
+        else:
+            previous.add_done_callback(finish)
+
+# In-memory cache of the dice set per channel id, so we don't have to hit the
+# channel settings db on every roll. Updated by the /settings command.
+_dice_set_cache: dict[int, DiceSet] = {}
+
 def dice_set_for_interaction(interaction: discord.Interaction) -> DiceSet:
     """Returns the dice set for the interaction's channel."""
-    dice_set = channel_settings.get_dice_set(interaction.channel_id)
-    print('Channel id:', interaction.channel_id)
-    print('Dice set:', dice_set)
+    dice_set = _dice_set_cache.get(interaction.channel_id)
+    if dice_set is None:
+        dice_set = channel_settings.get_dice_set(interaction.channel_id)
+        _dice_set_cache[interaction.channel_id] = dice_set
     return dice_set
 
 
@@ -36,7 +123,8 @@ class SettingsController:
         """
         dice_set = DiceSet(dice_set_str)
         channel_settings.set_dice_set(interaction.channel_id, dice_set)
-        embed = discord.Embed(description=f'Set the dice set to {dice_set.value}', color=EMBED_COLOR)
+        _dice_set_cache[interaction.channel_id] = dice_set
+        embed = make_embed(f'Set the dice set to {dice_set.value}')
         await interaction.response.send_message(embed=embed)
 
 
@@ -49,18 +137,36 @@ class RollController:
         well as a view containing buttons for rerolling, free rerolling,
         and going all in.
         """
+        # Discord already enforces this range for the command's argument, but
+        # we check again before deferring, as a deferred response can't be
+        # turned into an ephemeral error.
+        if not 1 <= num_dice <= MAX_DICE:
+            await interaction.response.send_message(
+                f'You can roll between 1 and {MAX_DICE} dice.', ephemeral=True)
+            return
+
+        # Acknowledge the interaction right away, so the roll itself doesn't
+        # count against Discord's response deadline.
+        await interaction.response.defer(thinking=True)
         dice_set = dice_set_for_interaction(interaction)
         roller = Roller(num_dice=num_dice)
         roller.roll()
+        can_reroll, can_free_reroll, can_go_all_in = roller.roll_history.available_actions()
         view = RollView(
             user_id=interaction.user.id,
             dice_set=dice_set,
-            can_reroll=roller.roll_history.can_reroll(),
-            can_free_reroll=roller.roll_history.can_free_reroll(),
-            can_go_all_in=roller.roll_history.can_go_all_in())
-        content = MessageGenerator(dice_set).generate_roll_message(roller.roll_history)
-        embed = discord.Embed(description=content, color=EMBED_COLOR)
-        await interaction.response.send_message(embed=embed, view=view)    
+            can_reroll=can_reroll,
+            can_free_reroll=can_free_reroll,
+            can_go_all_in=can_go_all_in,
+            roll_history=roller.roll_history)
+        content = message_generator_for_dice_set(dice_set).generate_roll_message(roller.roll_history)
+        embed = make_embed(content)
+        try:
+            await interaction.followup.send(embed=embed, view=view)
+        except discord.HTTPException as e:
+            # Replace the "thinking" message, which would otherwise stay around.
+            log.warning('Failed to send roll message: %s', e)
+            await interaction.edit_original_response(content='Sorry, the roll could not be posted.')
 
 
 class CoinController:
@@ -70,7 +176,7 @@ class CoinController:
 
         Responds with a message containing the result of the coin flip.
         """
-        embed = discord.Embed(description=MessageGenerator().generate_coin_message(), color=EMBED_COLOR)
+        embed = make_embed(_default_message_generator.generate_coin_message())
         await interaction.response.send_message(embed=embed)
 
 
@@ -81,7 +187,7 @@ class D6Controller:
 
         Responds with a message containing the result of the d6 roll.
         """
-        embed = discord.Embed(description=MessageGenerator().generate_d6_message(), color=EMBED_COLOR)
+        embed = make_embed(_default_message_generator.generate_d6_message())
         await interaction.response.send_message(embed=embed)
 
 
@@ -92,49 +198,128 @@ class HelpController:
 
         Responds with a help message.
         """
-        embed = discord.Embed(description=MessageGenerator().generate_help_message(), color=EMBED_COLOR)
-        await interaction.response.send_message(embed=embed)
+        await interaction.response.send_message(embed=_HELP_EMBED)
 
 
 class RollView(discord.ui.View):
     """A view for the roll command.
 
     Contains buttons for rerolling, free rerolling, and going all in.
+    The buttons carry the packed roll history, so their callbacks don't have
+    to parse it from the message.
     """
-    def __init__(self, user_id: int, dice_set: DiceSet, can_reroll: bool, can_free_reroll: bool, can_go_all_in: bool):
+    def __init__(self, user_id: int, dice_set: DiceSet, can_reroll: bool, can_free_reroll: bool, can_go_all_in: bool,
+                 roll_history: RollHistory):
         super().__init__(timeout=None)
-        if can_reroll:
-            self.add_item(DynamicRerollButton(user_id, dice_set))
-        if can_free_reroll:
-            self.add_item(DynamicFreeRerollButton(user_id, dice_set))
-        if can_go_all_in:
-            self.add_item(DynamicAllInButton(user_id, dice_set))
+        state = None
+        if roll_history.num_dice <= RollHistory.MAX_PACKED_DICE:
+            state = roll_history.pack()
+        actions = (('reroll', can_reroll), ('free_reroll', can_free_reroll), ('all_in', can_go_all_in))
+        # NB: We can't assign the children directly, as add_item() also binds
+        #     each item to the view.
+        for button in [DynamicRollButton(action, user_id, dice_set, state) for action, enabled in actions if enabled]:
+            self.add_item(button)
+
+
+@functools.lru_cache(maxsize=4096)
+def button_custom_id(action: str, user_id: int, dice_set: DiceSet) -> str:
+    """Returns the custom id for a reroll button of the given user and dice set."""
+    return f'roll:{action}:user:{user_id}:dice_set:{dice_set.value}'
+
+
+class RollAction(NamedTuple):
+    """Describes one of the actions available via a DynamicRollButton.
+
+    Attributes:
+        label: The button label.
+        style: The button style.
+        is_allowed: The RollHistory method checking whether the action is allowed.
+        perform: The Roller method performing the action.
+        error_message: The error raised if the action isn't allowed.
+    """
+    label: str
+    style: discord.ButtonStyle
+    is_allowed: Callable[[RollHistory], bool]
+    perform: Callable[[Roller], None]
+    error_message: str
 
 
-class AbstractDynamicButton(discord.ui.DynamicItem[discord.ui.Button], ABC, template=r''):
-    """An abstract class for dynamic buttons.
-    
-    We're wrapping the reroll buttons in DynamicItems so they continue to work
-    after the bot restarts. And we're extracting the common functionality into
-    this abstract class.
+class DynamicRollButton(
+        discord.ui.DynamicItem[discord.ui.Button],
+        template=re.compile(
+            r'roll:(?P<action>reroll|free_reroll|all_in):user:(?P<user_id>[0-9]+):dice_set:(?P<dice_set>[A-Za-z0-9_]+)'
+            r'(?::state:(?P<state>[A-Za-z0-9_-]+))?',
+            re.ASCII)):
+    """A button for rerolling, free rerolling, or going all in.
 
-    Subclasses must implement the callback method.
+    We're wrapping the reroll buttons in DynamicItems so they continue to work
+    after the bot restarts. A single class handles all actions, as they only
+    differ in the details listed in ACTIONS. The action is encoded in the
+    button's custom id, along with the packed roll history (see
+    RollHistory.pack()). Buttons on messages sent before the roll history was
+    included, or for rolls too large to pack, fall back to parsing the message.
+
+    Attributes:
+        action: The button's action, one of the keys of ACTIONS.
+        user_id: The ID of the user who may press the button.
+        dice_set: The dice set used for the roll.
+        state: The packed roll history, or None if not available.
     """
-    def __init__(self, user_id: int, dice_set: DiceSet, label: str, style: discord.ButtonStyle, custom_id: str):
+    ACTIONS = {
+        'reroll': RollAction(
+            label='Re-roll',
+            style=discord.ButtonStyle.green,
+            is_allowed=RollHistory.can_reroll,
+            perform=Roller.reroll,
+            error_message='Cannot perform reroll'),
+        'free_reroll': RollAction(
+            label='Free Re-roll',
+            style=discord.ButtonStyle.blurple,
+            is_allowed=RollHistory.can_free_reroll,
+            perform=Roller.free_reroll,
+            error_message='Cannot perform free reroll'),
+        'all_in': RollAction(
+            label='All In',
+            style=discord.ButtonStyle.red,
+            is_allowed=RollHistory.can_go_all_in,
+            perform=Roller.all_in,
+            error_message='Cannot go all in'),
+    }
+
+    def __init__(self, action: str, user_id: int, dice_set: DiceSet, state: str | None = None):
+        self.action = action
         self.user_id = user_id
         self.dice_set = dice_set
+        self.state = state
+        roll_action = self.ACTIONS[action]
+        custom_id = button_custom_id(action, user_id, dice_set)
+        if state:
+            custom_id += f':state:{state}'
         super().__init__(
-            discord.ui.Button(label=label, style=style, custom_id=custom_id))
+            discord.ui.Button(label=roll_action.label, style=roll_action.style, custom_id=custom_id))
 
     @classmethod
     async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Button, match: re.Match[str], /):
         user_id = int(match['user_id'])
         dice_set = DiceSet(match['dice_set'])
-        return cls(user_id, dice_set)
+        return cls(match['action'], user_id, dice_set, match['state'])
 
-    @abstractmethod
     async def callback(self, interaction: discord.Interaction):
-        pass
+        roll_action = self.ACTIONS[self.action]
+        async with button_callback_slot(interaction.channel_id) as wait_for_turn:
+            await interaction.response.defer()
+            await wait_for_turn()
+            log.debug('Performing %s...', self.action)
+            if self.state:
+                roll_history = RollHistory.unpack(self.state)
+            else:
+                roll_history = MessageParser(interaction, self.dice_set).roll_history
+            if not roll_action.is_allowed(roll_history):
+                # The interaction is already deferred, so report this via a followup.
+                await interaction.followup.send(f'{roll_action.error_message}.', ephemeral=True)
+                return
+            roll_action.perform(Roller(roll_history=roll_history))
+            await self._update_message(interaction, roll_history)
 
     async def interaction_check(self, interaction):
         if interaction.user.id == self.user_id:
@@ -144,79 +329,22 @@ class AbstractDynamicButton(discord.ui.DynamicItem[discord.ui.Button], ABC, temp
             return False
 
     async def _update_message(self, interaction: discord.Interaction, roll_history: RollHistory):
-        updated_view = RollView(
-            user_id=interaction.user.id,
-            dice_set=self.dice_set,
-            can_reroll=roll_history.can_reroll(),
-            can_free_reroll=roll_history.can_free_reroll(),
-            can_go_all_in=roll_history.can_go_all_in())
-
-        message = MessageGenerator(self.dice_set).generate_roll_message(roll_history)
-        embed = discord.Embed(description=message, color=EMBED_COLOR)
+        can_reroll, can_free_reroll, can_go_all_in = roll_history.available_actions()
+        # Once no more rerolls are possible, we simply remove the buttons, rather
+        # than sending an empty view.
+        updated_view = None
+        if can_reroll or can_free_reroll or can_go_all_in:
+            updated_view = RollView(
+                user_id=interaction.user.id,
+                dice_set=self.dice_set,
+                can_reroll=can_reroll,
+                can_free_reroll=can_free_reroll,
+                can_go_all_in=can_go_all_in,
+                roll_history=roll_history)
+
+        message = message_generator_for_dice_set(self.dice_set).generate_roll_message(roll_history)
+        embed = make_embed(message)
         try:
-            await interaction.response.edit_message(embed=embed, view=updated_view)
-        except Exception as e:
-            print(f"Failed to update message: {e}")
-
-
-class DynamicRerollButton(AbstractDynamicButton, template=r'roll:reroll:user:(?P<user_id>[0-9]+):dice_set:(?P<dice_set>\w+)'):
-    def __init__(self, user_id: int, dice_set: DiceSet):
-        self.user_id = user_id
-        self.dice_set = dice_set
-        super().__init__(
-            user_id=user_id,
-            dice_set=dice_set,
-            label='Re-roll',
-            style=discord.ButtonStyle.green,
-            custom_id=f'roll:reroll:user:{user_id}:dice_set:{dice_set.value}')
-
-    async def callback(self, interaction: discord.Interaction):
-        print('Rerolling...')
-        roll_history = MessageParser(interaction, self.dice_set).roll_history
-        if not roll_history.can_reroll():
-            raise RuntimeError('Cannot perform reroll')
-        Roller(roll_history=roll_history).reroll()
-
-        await self._update_message(interaction, roll_history)
-
-
-class DynamicFreeRerollButton(AbstractDynamicButton, template=r'roll:free_reroll:user:(?P<user_id>[0-9]+):dice_set:(?P<dice_set>\w+)'):
-    def __init__(self, user_id: int, dice_set: DiceSet):
-        self.user_id = user_id
-        self.dice_set = dice_set
-        super().__init__(
-            user_id=user_id,
-            dice_set=dice_set,
-            label='Free Re-roll',
-            style=discord.ButtonStyle.blurple,
-            custom_id=f'roll:free_reroll:user:{user_id}:dice_set:{dice_set.value}')
-
-    async def callback(self, interaction: discord.Interaction):
-        print('Free rerolling...')
-        roll_history = MessageParser(interaction, self.dice_set).roll_history
-        if not roll_history.can_free_reroll():
-            raise RuntimeError('Cannot perform free reroll')
-        Roller(roll_history=roll_history).free_reroll()
-
-        await self._update_message(interaction, roll_history)
-
-
-class DynamicAllInButton(AbstractDynamicButton, template=r'roll:all_in:user:(?P<user_id>[0-9]+):dice_set:(?P<dice_set>\w+)'):
-    def __init__(self, user_id: int, dice_set: DiceSet):
-        self.user_id = user_id
-        self.dice_set = dice_set
-        super().__init__(
-            user_id=user_id,
-            dice_set=dice_set,
-            label='All In',
-            style=discord.ButtonStyle.red,
-            custom_id=f'roll:all_in:user:{user_id}:dice_set:{dice_set.value}')
-
-    async def callback(self, interaction: discord.Interaction):
-        print('All in...')
-        roll_history = MessageParser(interaction, self.dice_set).roll_history
-        if not roll_history.can_go_all_in():
-            raise RuntimeError('Cannot go all in')
-        Roller(roll_history=roll_history).all_in()
-
-        await self._update_message(interaction, roll_history)
+            await interaction.edit_original_response(embed=embed, view=updated_view)
+        except discord.HTTPException as e:
+            log.warning('Failed to update message: %s', e)
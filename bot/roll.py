@@ -1,5 +1,7 @@
 """This module handles the actual dice rolling logic."""
+import base64
 import random
+import struct
 from enum import Enum
 
 # Enum that defines the different phases of a roll
@@ -124,6 +126,10 @@ class RollHistory:
         num_dice: The number of dice rolled.
         rolls: A dictionary that maps the phase of the roll to the Roll object.
     """
+    # Packed rolls store the count of each die face in a single byte.
+    MAX_PACKED_DICE = 255
+    _PACKED_ROLL_FORMAT = struct.Struct('7B')
+
     def __init__(self):
         """Initializes the RollHistory object."""
         self.num_dice = None
@@ -185,10 +191,55 @@ class RollHistory:
             return True
         return False
 
+    def available_actions(self):
+        """Returns a (can_reroll, can_free_reroll, can_go_all_in) tuple.
+
+        Equivalent to calling the three methods individually, but avoids
+        evaluating the shared conditions of can_reroll and can_free_reroll twice.
+        A regular reroll has the same requirements as a free reroll, plus at least
+        one basic success.
+        """
+        can_free_reroll = self.can_free_reroll()
+        can_reroll = can_free_reroll and self._has_at_least_one_success()
+        return can_reroll, can_free_reroll, self.can_go_all_in()
+
     def _has_at_least_one_success(self):
         """Returns true if the roll includes at least one basic success."""
         return any(num_matches > 1 for num_matches in self.get_final_roll().matches)
     
+    def pack(self):
+        """Packs the rolls into a compact, URL safe string.
+
+        Each roll is stored as its phase followed by the count of each die face,
+        which is enough to restore it since the dice are sorted anyway.
+
+        Raises:
+            ValueError: If more than MAX_PACKED_DICE dice were rolled.
+        """
+        if self.num_dice > self.MAX_PACKED_DICE:
+            raise ValueError(f'Cannot pack rolls with more than {self.MAX_PACKED_DICE} dice.')
+        data = b''
+        for phase, roll in sorted(self.rolls.items(), key=lambda item: item[0].value):
+            counts = [roll.dice.count(face) for face in range(1, 7)]
+            data += self._PACKED_ROLL_FORMAT.pack(phase.value, *counts)
+        return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+    @classmethod
+    def unpack(cls, state: str):
+        """Restores a roll history from a string created by pack().
+
+        Raises:
+            ValueError: If the string is not a valid packed roll history.
+        """
+        data = base64.urlsafe_b64decode(state + '=' * (-len(state) % 4))
+        if not data or len(data) % cls._PACKED_ROLL_FORMAT.size:
+            raise ValueError(f'Invalid packed roll history: {state}')
+        roll_history = cls()
+        for phase_value, *counts in cls._PACKED_ROLL_FORMAT.iter_unpack(data):
+            dice = [face for face, count in enumerate(counts, start=1) for _ in range(count)]
+            roll_history.add_roll(RollPhase(phase_value), Roll(dice))
+        return roll_history
+
     def __str__(self):
         return f'RollHistory(num_dice={self.num_dice}, rolls={self.rolls})'
 
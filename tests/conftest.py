@@ -0,0 +1,7 @@
+import os
+import tempfile
+
+# bot.config requires a Discord token, and bot.channel_settings opens its db on
+# import. Provide both before any test module imports the controller layer.
+os.environ.setdefault('DISCORD_TOKEN', 'test-token')
+os.environ.setdefault('CHANNEL_SETTINGS_DB', os.path.join(tempfile.mkdtemp(), 'channel_settings.db'))
@@ -0,0 +1,204 @@
+import asyncio
+import random
+from types import SimpleNamespace
+import discord
+import pytest
+from bot.controller import (
+    MAX_DICE, DynamicRollButton, RollController, button_callback_slot, message_generator_for_dice_set)
+from bot.dice import DiceSet
+from bot.message import MessageParser
+from bot.roll import Roll, RollHistory, RollPhase, Roller
+
+@pytest.mark.asyncio
+async def test_button_callback_slot_preserves_arrival_order():
+    order = []
+
+    async def callback(name, defer_delay):
+        async with button_callback_slot(1) as wait_for_turn:
+            # Simulate a defer() round trip that completes out of order.
+            await asyncio.sleep(defer_delay)
+            await wait_for_turn()
+            order.append(name)
+
+    await asyncio.gather(callback('first', 0.03), callback('second', 0.01), callback('third', 0))
+    assert order == ['first', 'second', 'third']
+
+@pytest.mark.asyncio
+async def test_button_callback_slot_releases_after_failure():
+    order = []
+
+    async def failing_callback():
+        async with button_callback_slot(1):
+            raise RuntimeError('defer failed')
+
+    async def callback():
+        async with button_callback_slot(1) as wait_for_turn:
+            await wait_for_turn()
+            order.append('second')
+
+    results = await asyncio.wait_for(
+        asyncio.gather(failing_callback(), callback(), return_exceptions=True), timeout=1)
+    assert isinstance(results[0], RuntimeError)
+    assert order == ['second']
+
+@pytest.mark.asyncio
+async def test_button_callback_slot_does_not_block_other_channels():
+    order = []
+
+    async def callback(channel_id, name, delay):
+        async with button_callback_slot(channel_id) as wait_for_turn:
+            await wait_for_turn()
+            await asyncio.sleep(delay)
+            order.append(name)
+
+    await asyncio.gather(callback(1, 'slow', 0.03), callback(2, 'fast', 0))
+    assert order == ['fast', 'slow']
+
+def _match_custom_id(custom_id):
+    return DynamicRollButton.__discord_ui_compiled_template__.fullmatch(custom_id)
+
+def _roll_history(*rolls):
+    roll_history = RollHistory()
+    for phase, dice in rolls:
+        roll_history.add_roll(phase, Roll(dice))
+    return roll_history
+
+def _interaction(mocker, embed=None):
+    interaction = mocker.MagicMock()
+    interaction.user.id = 1
+    interaction.channel_id = 2
+    interaction.response.defer = mocker.AsyncMock()
+    interaction.response.send_message = mocker.AsyncMock()
+    interaction.followup.send = mocker.AsyncMock()
+    interaction.edit_original_response = mocker.AsyncMock()
+    interaction.message = SimpleNamespace(embeds=[embed] if embed else [])
+    return interaction
+
+def test_template_matches_legacy_custom_id():
+    match = _match_custom_id('roll:reroll:user:1:dice_set:outgunned')
+    assert match
+    assert match['action'] == 'reroll'
+    assert match['state'] is None
+
+def test_template_matches_custom_id_with_state():
+    roll_history = _roll_history((RollPhase.INITIAL, [1, 1, 2, 3, 4]))
+    button = DynamicRollButton('free_reroll', 1, DiceSet.HOUSEHOLD, roll_history.pack())
+    match = _match_custom_id(button.custom_id)
+    assert match
+    assert match['action'] == 'free_reroll'
+    assert match['dice_set'] == 'household'
+    assert match['state'] == roll_history.pack()
+
+@pytest.mark.asyncio
+async def test_from_custom_id_restores_state():
+    roll_history = _roll_history((RollPhase.INITIAL, [1, 1, 2, 3, 4]), (RollPhase.REROLL, [1, 1, 4, 5, 5]))
+    custom_id = DynamicRollButton('all_in', 123, DiceSet.NUMBERS, roll_history.pack()).custom_id
+    button = await DynamicRollButton.from_custom_id(None, None, _match_custom_id(custom_id))
+    assert (button.action, button.user_id, button.dice_set) == ('all_in', 123, DiceSet.NUMBERS)
+    assert button.state == roll_history.pack()
+    assert button.custom_id == custom_id
+
+@pytest.mark.asyncio
+async def test_from_custom_id_without_state():
+    button = await DynamicRollButton.from_custom_id(
+        None, None, _match_custom_id('roll:reroll:user:1:dice_set:outgunned'))
+    assert button.state is None
+    assert button.custom_id == 'roll:reroll:user:1:dice_set:outgunned'
+
+@pytest.mark.asyncio
+async def test_callback_without_state_parses_message(mocker):
+    roll_history = _roll_history((RollPhase.INITIAL, [1, 1, 2, 3, 4]))
+    message = message_generator_for_dice_set(DiceSet.NUMBERS).generate_roll_message(roll_history)
+    interaction = _interaction(mocker, discord.Embed(description=message))
+    mocker.patch.object(Roller, 'roll_dice', return_value=[5, 6, 6])
+
+    button = await DynamicRollButton.from_custom_id(
+        None, None, _match_custom_id('roll:reroll:user:1:dice_set:numbers'))
+    await button.callback(interaction)
+
+    embed = interaction.edit_original_response.call_args.kwargs['embed']
+    assert embed.description.startswith(
+        '\nRoll: :one: :one: :two: :three: :four:\nRe-roll :thumbsup:: :one: :one: :five: :six: :six:\n')
+
+@pytest.mark.asyncio
+async def test_callback_with_state_does_not_parse_message(mocker):
+    roll_history = _roll_history((RollPhase.INITIAL, [1, 1, 2, 3, 4]))
+    # No embed on the message, so parsing it would fail.
+    interaction = _interaction(mocker)
+    mocker.patch.object(Roller, 'roll_dice', return_value=[5, 6, 6])
+
+    button = DynamicRollButton('reroll', 1, DiceSet.NUMBERS, roll_history.pack())
+    await button.callback(interaction)
+
+    embed = interaction.edit_original_response.call_args.kwargs['embed']
+    assert embed.description.startswith(
+        '\nRoll: :one: :one: :two: :three: :four:\nRe-roll :thumbsup:: :one: :one: :five: :six: :six:\n')
+
+def test_unpacked_state_matches_parsed_message():
+    random.seed(0)
+    for _ in range(500):
+        roller = Roller(num_dice=random.randint(1, 12))
+        roller.roll()
+        roll_history = roller.roll_history
+        while True:
+            actions = [action for action, enabled in zip(
+                (Roller.reroll, Roller.free_reroll, Roller.all_in), roll_history.available_actions()) if enabled]
+            message = message_generator_for_dice_set(DiceSet.NUMBERS).generate_roll_message(roll_history)
+            interaction = SimpleNamespace(message=SimpleNamespace(embeds=[discord.Embed(description=message)]))
+            parsed = MessageParser(interaction, DiceSet.NUMBERS).roll_history
+            unpacked = RollHistory.unpack(roll_history.pack())
+
+            assert {phase: roll.dice for phase, roll in unpacked.rolls.items()} == \
+                {phase: roll.dice for phase, roll in parsed.rolls.items()}
+            assert unpacked.available_actions() == parsed.available_actions()
+            if not actions:
+                break
+            random.choice(actions)(Roller(roll_history=unpacked))
+            roll_history = unpacked
+
+def test_custom_id_length_limit():
+    largest_roll = [6] * RollHistory.MAX_PACKED_DICE
+    roll_history = _roll_history((RollPhase.INITIAL, largest_roll), (RollPhase.FREE_REROLL, largest_roll))
+    user_id = 10 ** 20 - 1
+    for action in DynamicRollButton.ACTIONS:
+        for dice_set in DiceSet:
+            button = DynamicRollButton(action, user_id, dice_set, roll_history.pack())
+            assert len(button.custom_id) <= 100, button.custom_id
+            assert _match_custom_id(button.custom_id)
+
+def test_max_dice_roll_message_fits_embed():
+    # Close to the worst case: the roll shows a re-roll and going all in, which
+    # failed, so each die shows up in three roll lines and in the (lost) matches.
+    dice = [2, 3, 4, 5] * 4 + [6, 6, 6, 1]
+    roll_history = _roll_history((RollPhase.INITIAL, dice), (RollPhase.REROLL, dice), (RollPhase.ALL_IN, dice))
+    roll_history.get_final_roll().mark_as_failed_all_in()
+    assert roll_history.num_dice == MAX_DICE
+    for dice_set in DiceSet:
+        message = message_generator_for_dice_set(dice_set).generate_roll_message(roll_history)
+        assert len(message) <= 4096, dice_set
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('num_dice', [0, MAX_DICE + 1])
+async def test_handle_roll_rejects_invalid_number_of_dice(mocker, num_dice):
+    interaction = _interaction(mocker)
+    await RollController().handle_roll(interaction, num_dice)
+    interaction.response.defer.assert_not_called()
+    assert interaction.response.send_message.call_args.kwargs['ephemeral']
+
+@pytest.mark.asyncio
+async def test_handle_roll_replaces_thinking_message_on_send_failure(mocker):
+    interaction = _interaction(mocker)
+    interaction.followup.send.side_effect = discord.HTTPException(
+        mocker.Mock(status=400, reason='Bad Request'), 'Invalid Form Body')
+    await RollController().handle_roll(interaction, 5)
+    interaction.edit_original_response.assert_called_once()
+    assert 'content' in interaction.edit_original_response.call_args.kwargs
+
+@pytest.mark.asyncio
+async def test_callback_reports_disallowed_action(mocker):
+    # A roll without successes doesn't allow a (regular) re-roll.
+    roll_history = _roll_history((RollPhase.INITIAL, [1, 2, 3, 4, 5]))
+    interaction = _interaction(mocker)
+    await DynamicRollButton('reroll', 1, DiceSet.NUMBERS, roll_history.pack()).callback(interaction)
+    interaction.followup.send.assert_called_once_with('Cannot perform reroll.', ephemeral=True)
+    interaction.edit_original_response.assert_not_called()
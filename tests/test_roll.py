@@ -1,5 +1,5 @@
 import pytest
-from bot.roll import Roll
+from bot.roll import Roll, RollHistory, RollPhase
 
 def test_roll_initialization():
     roll = Roll([1, 4, 2, 3, 5, 6, 3])
@@ -55,3 +55,53 @@ def test_is_better_than():
     assert not large_roll_with_4_basic.is_better_than(large_roll_with_1_extreme)
     assert not large_roll_with_1_extreme.is_better_than(large_roll_with_3_critical)
     assert not large_roll_with_3_critical.is_better_than(large_roll_with_1_extreme)
+
+def test_available_actions():
+    roll_history = RollHistory()
+    roll_history.add_roll(RollPhase.INITIAL, Roll([1, 1, 2, 3, 4]))
+    assert roll_history.available_actions() == (True, True, False)
+
+    roll_history.add_roll(RollPhase.REROLL, Roll([1, 1, 5, 5, 6]))
+    assert roll_history.available_actions() == (False, False, True)
+
+    roll_history.add_roll(RollPhase.ALL_IN, Roll([1, 1, 5, 5, 5]))
+    assert roll_history.available_actions() == (False, False, False)
+
+def test_available_actions_without_success():
+    roll_history = RollHistory()
+    roll_history.add_roll(RollPhase.INITIAL, Roll([1, 2, 3, 4, 5]))
+    assert roll_history.available_actions() == (False, True, False)
+    assert roll_history.available_actions() == (
+        roll_history.can_reroll(), roll_history.can_free_reroll(), roll_history.can_go_all_in())
+
+def test_pack_and_unpack():
+    roll_history = RollHistory()
+    roll_history.add_roll(RollPhase.INITIAL, Roll([1, 1, 2, 3, 4, 6, 6, 6]))
+    roll_history.add_roll(RollPhase.FREE_REROLL, Roll([1, 1, 2, 2, 5, 6, 6, 6]))
+
+    unpacked = RollHistory.unpack(roll_history.pack())
+    assert unpacked.num_dice == 8
+    assert unpacked.rolls.keys() == roll_history.rolls.keys()
+    assert unpacked.get_roll(RollPhase.INITIAL).dice == [1, 1, 2, 3, 4, 6, 6, 6]
+    assert unpacked.get_roll(RollPhase.FREE_REROLL).dice == [1, 1, 2, 2, 5, 6, 6, 6]
+    assert unpacked.available_actions() == roll_history.available_actions()
+
+def test_pack_is_url_safe_and_compact():
+    roll_history = RollHistory()
+    roll_history.add_roll(RollPhase.INITIAL, Roll([6] * 255))
+    roll_history.add_roll(RollPhase.REROLL, Roll([5] * 255))
+    state = roll_history.pack()
+    assert len(state) == 19
+    assert all(c.isalnum() or c in '-_' for c in state)
+
+def test_pack_too_many_dice():
+    roll_history = RollHistory()
+    roll_history.add_roll(RollPhase.INITIAL, Roll([1] * 256))
+    with pytest.raises(ValueError):
+        roll_history.pack()
+
+def test_unpack_invalid():
+    with pytest.raises(ValueError):
+        RollHistory.unpack('')
+    with pytest.raises(ValueError):
+        RollHistory.unpack('AQID')